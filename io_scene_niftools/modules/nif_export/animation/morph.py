@@ -37,6 +37,8 @@
 #
 # ***** END LICENSE BLOCK *****
 
+import numpy as np
+
 from generated.formats.nif import classes as NifClasses
 from pyffi.formats.egm import EgmFormat
 
@@ -54,7 +56,8 @@ class MorphAnimation(Animation):
         super().__init__()
         EGMData.data = None
 
-    def export_morph(self, b_mesh, n_trishape, vertmap):
+    def export_morph(self, b_mesh, n_trishape, vertmap_indptr, vertmap_indices):
+        """vertmap_indptr and vertmap_indices map blender vertices to nif vertices as compressed sparse rows"""
         NifLog.debug(f"Checking {b_mesh.name} for shape keys")
         # shape keys are only present on non-evaluated meshes!
         b_key = b_mesh.shape_keys
@@ -66,7 +69,7 @@ class MorphAnimation(Animation):
                 # egm export!
                 self.export_egm(b_key.key_blocks)
             elif b_key.animation_data:
-                self.export_morph_animation(b_mesh, b_key, n_trishape, vertmap)
+                self.export_morph_animation(b_mesh, b_key, n_trishape, vertmap_indptr, vertmap_indices)
 
     def export_egm(self, key_blocks):
         EGMData.data = EgmFormat.Data(num_vertices=len(key_blocks[0].data))
@@ -85,7 +88,7 @@ class MorphAnimation(Animation):
                 relative_vertices.append(key_vert.co - base_vert.co)
             morph.set_relative_vertices(relative_vertices)
 
-    def export_morph_animation(self, b_mesh, b_key, n_trishape, vertmap):
+    def export_morph_animation(self, b_mesh, b_key, n_trishape, vertmap_indptr, vertmap_indices):
         
         # regular morph_data export
         b_shape_action = self.get_active_action(b_key)
@@ -113,6 +116,8 @@ class MorphAnimation(Animation):
         # TODO [morph] just guessing here, data seems to be zero always
         morph_ctrl.num_unknown_ints = len(b_key.key_blocks)
         morph_ctrl.reset_field("unknown_ints")
+        # for each blender vertex, the list of nif vertices it was exported to
+        vertmap = [n_v_indices.tolist() for n_v_indices in np.split(vertmap_indices, vertmap_indptr[1:-1])]
         for key_block_num, key_block in enumerate(b_key.key_blocks):
             # export morphed vertices
             n_morph = morph_data.morphs[key_block_num]
@@ -120,7 +125,7 @@ class MorphAnimation(Animation):
             NifLog.info(f"Exporting n_morph {key_block.name}: vertices")
             n_morph.arg = morph_data.num_vertices
             n_morph.reset_field("vectors")
-            for b_v_index, (n_v_indices, b_vert) in enumerate(list(zip(vertmap, key_block.data))):
+            for b_v_index, (n_v_indices, b_vert) in enumerate(zip(vertmap, key_block.data)):
                 # see if this b_vert is used in the nif
                 if not n_v_indices:
                     continue
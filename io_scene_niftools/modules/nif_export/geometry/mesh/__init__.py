@@ -41,6 +41,7 @@ import bmesh
 import mathutils
 import numpy as np
 import struct
+from contextlib import contextmanager
 
 from generated.formats.nif import classes as NifClasses
 
@@ -55,6 +56,11 @@ from io_scene_niftools.utils.singleton import NifOp, NifData
 from io_scene_niftools.utils.logging import NifLog, NifError
 from io_scene_niftools.modules.nif_export.geometry.mesh.skin_partition import update_skin_partition
 
+# default trishape flags for games that do not depend on the shape
+GAME_DEFAULT_FLAGS = {'OBLIVION': 0x000E, 'FALLOUT_3': 0x000E, 'SKYRIM': 0x000E,
+                      'SID_MEIER_S_RAILROADS': 0x0010, 'CIVILIZATION_IV': 0x0010,
+                      'EMPIRE_EARTH_II': 0x0016}
+
 
 class Mesh:
 
@@ -62,6 +68,8 @@ class Mesh:
         self.texture_helper = NiTextureProp.get()
         self.object_property = ObjectProperty()
         self.morph_anim = MorphAnimation()
+        # blender bone -> exported nif node, see get_bone_block
+        self.bone_blocks = {}
 
     def export_tri_shapes(self, b_obj, n_parent, n_root, trishape_name=None):
         """
@@ -78,9 +86,13 @@ class Mesh:
 
         assert (b_obj.type == 'MESH')
 
-        # get mesh from b_obj, and evaluate the mesh with modifiers applied, too
+        # evaluate the mesh with modifiers applied, the evaluated copy is freed once its shapes are exported
+        with self.get_evaluated_mesh(b_obj) as eval_mesh:
+            return self.export_evaluated_tri_shapes(b_obj, eval_mesh, n_parent, n_root, trishape_name)
+
+    def export_evaluated_tri_shapes(self, b_obj, eval_mesh, n_parent, n_root, trishape_name):
+        """Export the shapes of b_obj from its evaluated mesh eval_mesh, see export_tri_shapes"""
         b_mesh = b_obj.data
-        eval_mesh = self.get_triangulated_mesh(b_obj)
         eval_mesh.calc_normals_split()
 
         # getVertsFromGroup fails if the mesh has no vertices
@@ -108,6 +120,48 @@ class Mesh:
         polygon_parts = self.get_polygon_parts(b_obj, eval_mesh)
         game = bpy.context.scene.niftools_scene.game
 
+        # read all per-vertex, per-loop and per-polygon data in bulk rather than accessing it element by element
+        vertex_cos = self.get_attribute_array(eval_mesh.vertices, "co", np.float32, 3)
+        loop_vertex_indices = self.get_attribute_array(eval_mesh.loops, "vertex_index", np.int32)
+        loop_normals = self.get_attribute_array(eval_mesh.loops, "normal", np.float32, 3)
+        loop_uvs = [self.get_attribute_array(uv_layer.data, "uv", np.float32, 2) for uv_layer in eval_mesh.uv_layers]
+        if mesh_hasvcol:
+            loop_colors = self.get_attribute_array(eval_mesh.vertex_colors[0].data, "color", np.float32, 4)
+        poly_loop_starts = self.get_attribute_array(eval_mesh.polygons, "loop_start", np.int32)
+        poly_loop_totals = self.get_attribute_array(eval_mesh.polygons, "loop_total", np.int32)
+        poly_material_indices = self.get_attribute_array(eval_mesh.polygons, "material_index", np.int32)
+        poly_use_smooth = self.get_attribute_array(eval_mesh.polygons, "use_smooth", bool)
+        poly_normals = self.get_attribute_array(eval_mesh.polygons, "normal", np.float32, 3)
+        # triangulation of the polygons, as (N, 3) array of loops
+        eval_mesh.calc_loop_triangles()
+        tri_loops = self.get_attribute_array(eval_mesh.loop_triangles, "loops", np.int32, 3)
+        tri_polys = self.get_attribute_array(eval_mesh.loop_triangles, "polygon_index", np.int32)
+        tri_material_indices = self.get_attribute_array(eval_mesh.loop_triangles, "material_index", np.int32)
+        # tangents are only calculated on demand
+        loop_tangents = None
+        loop_bitangent_signs = None
+
+        # face corner normals: smooth = vertex normal, non-smooth = face normal
+        loop_polys = np.repeat(np.arange(len(poly_loop_totals), dtype=np.int32), poly_loop_totals)
+        corner_normals = np.where(poly_use_smooth[loop_polys, np.newaxis], loop_normals, poly_normals[loop_polys])
+
+        # face corner data quantized to an int32 lattice, one row per loop, starting with the vertex index
+        # loops with equal rows share their nif vertex
+        corner_keys_without_normals = np.hstack([loop_vertex_indices[:, np.newaxis]] +
+                                                [self.quantize_face_corner_data(loop_uv) for loop_uv in loop_uvs] +
+                                                ([self.quantize_face_corner_data(loop_colors)] if mesh_hasvcol else []))
+        corner_keys_with_normals = np.hstack((corner_keys_without_normals,
+                                              self.quantize_face_corner_data(corner_normals)))
+
+        # the polygons of each material, ignoring degenerate polygons
+        valid_polys = np.flatnonzero(poly_loop_totals >= 3)
+        material_polys_per_index = [valid_polys[group] for group in
+                                    self.group_indices(poly_material_indices[valid_polys], len(mesh_materials))]
+        # the triangles of each material
+        material_tris_per_index = self.group_indices(tri_material_indices, len(mesh_materials))
+        # blender loop -> nif vertex, only valid for the loops of the current material
+        loop_vertices = np.full(len(loop_vertex_indices), -1, dtype=np.int32)
+
         # Non-textured materials, vertex colors are used to color the mesh
         # Textured materials, they represent lighting details
 
@@ -147,7 +201,7 @@ class Mesh:
                 else:
                     n_geom.name = block_store.get_full_name(n_geom)
 
-            self.set_mesh_flags(b_obj, n_geom)
+            self.set_mesh_flags(b_obj, n_geom, game)
 
             # extra shader for Sid Meier's Railroads
             if game == 'SID_MEIER_S_RAILROADS':
@@ -192,15 +246,6 @@ class Mesh:
             # produce lists of vertices, uv-vertices, normals, vertex colors, and face indices.
 
             b_uv_layers = eval_mesh.uv_layers
-            vertquad_list = []  # (vertex, uv coordinate, normal, vertex color) list
-            vertex_map = [None for _ in range(len(eval_mesh.vertices))]  # blender vertex -> nif vertices
-            vertex_positions = []
-            normals = []
-            vertex_colors = []
-            uv_coords = []
-            triangles = []
-            # for each face in triangles, a body part index
-            bodypartfacemap = []
             polygons_without_bodypart = []
 
             if eval_mesh.polygons:
@@ -213,109 +258,66 @@ class Mesh:
             if b_uv_layers and mesh_hasnormals:
                 if game in ('OBLIVION', 'FALLOUT_3', 'SKYRIM') or (game in self.texture_helper.USED_EXTRA_SHADER_TEXTURES):
                     use_tangents = True
-                    eval_mesh.calc_tangents(uvmap=b_uv_layers[0].name)
-                    tangents = []
-                    bitangent_signs = []
+                    if loop_tangents is None:
+                        eval_mesh.calc_tangents(uvmap=b_uv_layers[0].name)
+                        loop_tangents = self.get_attribute_array(eval_mesh.loops, "tangent", np.float32, 3)
+                        loop_bitangent_signs = self.get_attribute_array(eval_mesh.loops, "bitangent_sign", np.float32)
 
             if game in ('FALLOUT_3', 'SKYRIM'):
                 if len(b_uv_layers) > 1:
                     raise NifError(f"{game} does not support multiple UV layers.")
 
-            for poly in eval_mesh.polygons:
-
-                # does the face belong to this n_geom?
-                if b_mat is not None and poly.material_index != b_mat_index:
-                    # we have a material but this face has another material, so skip
-                    continue
-
-                f_numverts = len(poly.vertices)
-                if f_numverts < 3:
-                    continue  # ignore degenerate polygons
-                assert ((f_numverts == 3) or (f_numverts == 4))  # debug
-
-                # find (vert, uv-vert, normal, vcol) quad, and if not found, create it
-                f_index = [-1] * f_numverts
-                for i, loop_index in enumerate(poly.loop_indices):
-
-                    fv_index = eval_mesh.loops[loop_index].vertex_index
-                    vertex = eval_mesh.vertices[fv_index]
-                    vertex_index = vertex.index
-                    fv = vertex.co
-
-                    # smooth = vertex normal, non-smooth = face normal)
-                    if mesh_hasnormals:
-                        if poly.use_smooth:
-                            fn = eval_mesh.loops[loop_index].normal
-                        else:
-                            fn = poly.normal
-                    else:
-                        fn = None
+            corner_keys = corner_keys_with_normals if mesh_hasnormals else corner_keys_without_normals
 
-                    fuv = [uv_layer.data[loop_index].uv for uv_layer in eval_mesh.uv_layers]
+            # the faces that belong to this n_geom
+            if b_mat is not None:
+                material_polys = material_polys_per_index[b_mat_index]
+            else:
+                # without a material, export all faces
+                material_polys = valid_polys
+
+            # find (vert, uv-vert, normal, vcol) quad of each face corner, and if not found, create it
+            material_loops = self.expand_ranges(poly_loop_starts[material_polys], poly_loop_totals[material_polys])
+            material_loop_vertices, vertex_loops = self.get_face_corner_vertices(corner_keys, material_loops)
+            loop_vertices[material_loops] = material_loop_vertices
+            if len(vertex_loops) > 65536:
+                raise NifError("Too many vertices. Decimate your mesh and try again.")
+
+            # the vertices, normals and vertex colors of the nif vertices
+            vertex_positions = vertex_cos[loop_vertex_indices[vertex_loops]]
+            if mesh_hasnormals:
+                normals = corner_normals[vertex_loops]
+            else:
+                normals = np.empty((0, 3), dtype=np.float32)
+            if mesh_hasvcol:
+                vertex_colors = loop_colors[vertex_loops]
+            else:
+                vertex_colors = np.empty((0, 4), dtype=np.float32)
 
-                    # TODO [geometry][mesh] Need to map b_verts -> n_verts
-                    if mesh_hasvcol:
-                        f_col = list(eval_mesh.vertex_colors[0].data[loop_index].color)
-                    else:
-                        f_col = None
-
-                    vertquad = (fv, fuv, fn, f_col)
-
-                    # check for duplicate vertquad?
-                    f_index[i] = len(vertquad_list)
-                    if vertex_map[vertex_index] is not None:
-                        # iterate only over vertices with the same vertex index
-                        for j in vertex_map[vertex_index]:
-                            # check if they have the same uvs, normals and colors
-                            if self.is_new_face_corner_data(vertquad, vertquad_list[j]):
-                                continue
-                            # all tests passed: so yes, we already have a vert with the same face corner data!
-                            f_index[i] = j
-                            break
-
-                    if f_index[i] > 65535:
-                        raise NifError("Too many vertices. Decimate your mesh and try again.")
-
-                    if f_index[i] == len(vertquad_list):
-                        # first: add it to the vertex map
-                        if not vertex_map[vertex_index]:
-                            vertex_map[vertex_index] = []
-                        vertex_map[vertex_index].append(len(vertquad_list))
-                        # new (vert, uv-vert, normal, vcol) quad: add it
-                        vertquad_list.append(vertquad)
-
-                        # add the vertex
-                        vertex_positions.append(vertquad[0])
-                        if mesh_hasnormals:
-                            normals.append(vertquad[2])
-                        if use_tangents:
-                            tangents.append(eval_mesh.loops[loop_index].tangent)
-                            bitangent_signs.append([eval_mesh.loops[loop_index].bitangent_sign])
-                        if mesh_hasvcol:
-                            vertex_colors.append(vertquad[3])
-                        if b_uv_layers:
-                            uv_coords.append(vertquad[1])
-
-                # now add the (hopefully, convex) face, in triangles
-                for i in range(f_numverts - 2):
-                    if (b_obj.scale.x + b_obj.scale.y + b_obj.scale.z) > 0:
-                        f_indexed = (f_index[0], f_index[1 + i], f_index[2 + i])
-                    else:
-                        f_indexed = (f_index[0], f_index[2 + i], f_index[1 + i])
-                    triangles.append(f_indexed)
+            # now add the faces, in triangles
+            if b_mat is not None:
+                material_tris = material_tris_per_index[b_mat_index]
+                triangle_loops = tri_loops[material_tris]
+                triangle_polys = tri_polys[material_tris]
+            else:
+                triangle_loops = tri_loops
+                triangle_polys = tri_polys
+            if (b_obj.scale.x + b_obj.scale.y + b_obj.scale.z) <= 0:
+                # flip the winding order
+                triangle_loops = triangle_loops[:, (0, 2, 1)]
+            triangles = [tuple(tri) for tri in loop_vertices[triangle_loops].tolist()]
 
-                    # add body part number
-                    if game not in ('FALLOUT_3', 'SKYRIM') or not polygon_parts:
-                        # TODO: or not self.EXPORT_FO3_BODYPARTS):
-                        bodypartfacemap.append(0)
-                    else:
-                        # add the polygon's body part
-                        part_index = polygon_parts[poly.index]
-                        if part_index >= 0:
-                            bodypartfacemap.append(part_index)
-                        else:
-                            # this signals an error
-                            polygons_without_bodypart.append(poly)
+            # for each face in triangles, a body part index
+            if game not in ('FALLOUT_3', 'SKYRIM') or not polygon_parts:
+                # TODO: or not self.EXPORT_FO3_BODYPARTS):
+                bodypartfacemap = [0] * len(triangles)
+            else:
+                # add the polygon's body part
+                triangle_parts = [polygon_parts[poly_index] for poly_index in triangle_polys.tolist()]
+                bodypartfacemap = [part_index for part_index in triangle_parts if part_index >= 0]
+                # -1 signals an error
+                polygons_without_bodypart = [poly_index for poly_index, part_index in
+                                             zip(triangle_polys.tolist(), triangle_parts) if part_index < 0]
 
             # check that there are no missing body part polygons
             if polygons_without_bodypart:
@@ -326,6 +328,16 @@ class Mesh:
             if len(vertex_positions) == 0:
                 continue  # m_4444x: skip 'empty' material indices
 
+            # uv coordinates of the nif vertices, per uv layer
+            uv_coords = np.array([loop_uv[vertex_loops] for loop_uv in loop_uvs], dtype=np.float32)
+            uv_coords.shape = (len(loop_uvs), len(vertex_loops), 2)
+
+            # blender vertex -> nif vertices, as compressed sparse rows: the nif vertices (indices) to which blender
+            # vertex v was mapped are vertex_map_indices[vertex_map_indptr[v]:vertex_map_indptr[v + 1]]
+            vertex_origins = loop_vertex_indices[vertex_loops]
+            vertex_map_indices = np.argsort(vertex_origins, kind='stable').astype(np.int32)
+            vertex_map_indptr = np.searchsorted(vertex_origins[vertex_map_indices], np.arange(len(eval_mesh.vertices) + 1))
+
             self.set_geom_data(n_geom, vertex_positions, normals, vertex_colors, uv_coords, b_uv_layers)
 
             # set triangles stitch strips for civ4
@@ -337,7 +349,9 @@ class Mesh:
             if use_tangents:
                 if game == 'SKYRIM':
                     n_geom.data.bs_data_flags.has_tangents = True
-                # calculate the bitangents using the normals, tangent list and bitangent sign
+                # calculate the bitangents using the normals, tangents and bitangent signs of the exported loops
+                tangents = loop_tangents[vertex_loops]
+                bitangent_signs = loop_bitangent_signs[vertex_loops, np.newaxis]
                 bitangents = bitangent_signs * np.cross(normals, tangents)
                 # B_tan: +d(B_u), B_bit: +d(B_v) and N_tan: +d(N_v), N_bit: +d(N_u)
                 # moreover, N_v = 1 - B_v, so d(B_v) = - d(N_v), therefore N_tan = -B_bit and N_bit = B_tan
@@ -359,53 +373,49 @@ class Mesh:
                     skininst, skindata = self.create_skin_inst_data(b_obj, b_obj_armature, polygon_parts)
                     n_geom.skin_instance = skininst
 
-                    # Vertex weights,  find weights and normalization factors
-                    vert_list = {}
-                    vert_norm = {}
-                    unweighted_vertices = []
-
-                    for bone_group in boneinfluences:
-                        b_list_weight = []
-                        b_vert_group = b_obj.vertex_groups[bone_group]
-
-                        for b_vert in eval_mesh.vertices:
-                            if len(b_vert.groups) == 0:  # check vert has weight_groups
-                                unweighted_vertices.append(b_vert.index)
-                                continue
-
-                            for g in b_vert.groups:
-                                if b_vert_group.name in boneinfluences:
-                                    if g.group == b_vert_group.index:
-                                        b_list_weight.append((b_vert.index, g.weight))
-                                        break
-
-                        vert_list[bone_group] = b_list_weight
+                    # Vertex weights, read all (vertex, vertex group, weight) triples in a single pass over the vertices
+                    weight_vertices = []
+                    weight_groups = []
+                    weights = []
+                    for b_vert in eval_mesh.vertices:
+                        for g in b_vert.groups:
+                            weight_vertices.append(b_vert.index)
+                            weight_groups.append(g.group)
+                            weights.append(g.weight)
+                    weight_vertices = np.array(weight_vertices, dtype=np.int32)
+                    weight_groups = np.array(weight_groups, dtype=np.int32)
+                    weights = np.array(weights, dtype=np.float64)
+                    num_vertices = len(eval_mesh.vertices)
+
+                    # check every vert has weight_groups
+                    unweighted_vertices = np.flatnonzero(np.bincount(weight_vertices, minlength=num_vertices) == 0)
+                    self.select_unweighted_vertices(b_obj, unweighted_vertices)
 
-                        # create normalisation groupings
-                        for v in vert_list[bone_group]:
-                            if v[0] in vert_norm:
-                                vert_norm[v[0]] += v[1]
-                            else:
-                                vert_norm[v[0]] = v[1]
+                    # create normalisation groupings from the bone weights
+                    bone_group_indices = {bone_group: b_obj.vertex_groups[bone_group].index for bone_group in boneinfluences}
+                    is_bone_weight = np.isin(weight_groups, list(bone_group_indices.values()))
+                    vert_norm = np.bincount(weight_vertices[is_bone_weight], weights=weights[is_bone_weight],
+                                            minlength=num_vertices)
+                    # skip vertices whose bone weights add up to zero
+                    is_bone_weight &= vert_norm[weight_vertices] != 0
 
-                    self.select_unweighted_vertices(b_obj, unweighted_vertices)
+                    vertex_map_counts = np.diff(vertex_map_indptr)
 
                     # for each bone, get the vertex weights and add its n_node to the NiSkinData
-                    for b_bone_name in boneinfluences:
-                        # find vertex weights
-                        vert_weights = {}
-                        for v in vert_list[b_bone_name]:
-                            # v[0] is the original vertex index
-                            # v[1] is the weight
-
-                            # vertex_map[v[0]] is the set of vertices (indices) to which v[0] was mapped
-                            # so we simply export the same weight as the original vertex for each new vertex
-
-                            # write the weights
-                            # extra check for multi material meshes
-                            if vertex_map[v[0]] and vert_norm[v[0]]:
-                                for vert_index in vertex_map[v[0]]:
-                                    vert_weights[vert_index] = v[1] / vert_norm[v[0]]
+                    for b_bone_name, group_index in bone_group_indices.items():
+                        # find the original vertex indices and normalized weights of this bone
+                        is_group_weight = is_bone_weight & (weight_groups == group_index)
+                        bone_vertices = weight_vertices[is_group_weight]
+                        bone_weights = weights[is_group_weight] / vert_norm[bone_vertices]
+
+                        # we simply export the same weight as the original vertex for each new vertex
+                        # vertices that were not mapped (multi material meshes) have no rows, so they are skipped
+                        bone_vertex_counts = vertex_map_counts[bone_vertices]
+                        new_vertices = vertex_map_indices[self.expand_ranges(vertex_map_indptr[bone_vertices],
+                                                                             bone_vertex_counts)]
+                        new_weights = np.repeat(bone_weights, bone_vertex_counts)
+                        # write the weights
+                        vert_weights = dict(zip(new_vertices.tolist(), new_weights.tolist()))
                         # add bone as influence, but only if there were actually any vertices influenced by the bone
                         if vert_weights:
                             # find bone in exported blocks
@@ -428,27 +438,25 @@ class Mesh:
 
             # export EGM or NiGeomMorpherController animation
             # shape keys are only present on the raw, unevaluated mesh
-            self.morph_anim.export_morph(b_mesh, n_geom, vertex_map)
+            self.morph_anim.export_morph(b_mesh, n_geom, vertex_map_indptr, vertex_map_indices)
         return n_geom
 
     def set_geom_data(self, n_geom, vertex_positions, normals, vertex_colors, uv_coords, b_uv_layers):
-        """Sets flat lists of per-vertex data to n_geom"""
+        """Sets arrays of per-vertex data to n_geom, uv_coords is an array of shape (uv layers, vertices, 2)"""
         # coords
         n_geom.data.num_vertices = len(vertex_positions)
         n_geom.data.has_vertices = True
         n_geom.data.reset_field("vertices")
-        for n_v, b_v in zip(n_geom.data.vertices, vertex_positions):
-            n_v.x, n_v.y, n_v.z = b_v
+        self.set_vector3_array(n_geom.data.vertices, vertex_positions)
         n_geom.data.update_center_radius()
         # normals
-        n_geom.data.has_normals = bool(normals)
+        n_geom.data.has_normals = len(normals) > 0
         n_geom.data.reset_field("normals")
-        for n_v, b_v in zip(n_geom.data.normals, normals):
-            n_v.x, n_v.y, n_v.z = b_v
+        self.set_vector3_array(n_geom.data.normals, normals)
         # vertex_colors
-        n_geom.data.has_vertex_colors = bool(vertex_colors)
+        n_geom.data.has_vertex_colors = len(vertex_colors) > 0
         n_geom.data.reset_field("vertex_colors")
-        for n_v, b_v in zip(n_geom.data.vertex_colors, vertex_colors):
+        for n_v, b_v in zip(n_geom.data.vertex_colors, vertex_colors.tolist()):
             n_v.r, n_v.g, n_v.b, n_v.a = b_v
         # uv_sets
         if bpy.context.scene.niftools_scene.nif_version == 0x14020007 and bpy.context.scene.niftools_scene.user_version_2:
@@ -462,13 +470,12 @@ class Mesh:
             if len(b_uv_layers) > 1:
                 NifLog.warn(f"More than one UV layers for game that doesn't support it, only using first UV layer")
         n_geom.data.reset_field("uv_sets")
-        for j, n_uv_set in enumerate(n_geom.data.uv_sets):
-            for i, n_uv in enumerate(n_uv_set):
-                if len(uv_coords[i]) == 0:
-                    continue  # skip non-uv textures
-                n_uv.u = uv_coords[i][j][0]
-                # NIF flips the texture V-coordinate (OpenGL standard)
-                n_uv.v = 1.0 - uv_coords[i][j][1]  # opengl standard
+        # NIF flips the texture V-coordinate (OpenGL standard)
+        nif_uv_coords = uv_coords.copy()
+        nif_uv_coords[..., 1] = 1.0 - uv_coords[..., 1]
+        for n_uv_set, b_uv_set in zip(n_geom.data.uv_sets, nif_uv_coords.tolist()):
+            for n_uv, b_uv in zip(n_uv_set, b_uv_set):
+                n_uv.u, n_uv.v = b_uv
 
     def export_skin_partition(self, b_obj, bodypartfacemap, triangles, n_geom):
         """Attaches a skin partition to n_geom if needed"""
@@ -554,10 +561,17 @@ class Mesh:
 
     def get_bone_block(self, b_bone):
         """For a blender bone, return the corresponding nif node from the blocks that have already been exported"""
-        for n_block, b_obj in block_store.block_to_obj.items():
-            if isinstance(n_block, NifClasses.NiNode) and b_bone == b_obj:
-                return n_block
-        raise NifError(f"Bone '{b_bone.name}' not found.")
+        n_block = self.bone_blocks.get(b_bone)
+        if n_block is None or n_block not in block_store.block_to_obj:
+            # the bone was exported after the lookup was last built, or by a previous export, so rebuild it
+            self.bone_blocks = {}
+            for n_node, b_obj in block_store.block_to_obj.items():
+                if isinstance(n_node, NifClasses.NiNode):
+                    self.bone_blocks.setdefault(b_obj, n_node)
+            n_block = self.bone_blocks.get(b_bone)
+            if n_block is None:
+                raise NifError(f"Bone '{b_bone.name}' not found.")
+        return n_block
 
     def get_polygon_parts(self, b_obj, b_mesh):
         """Returns the body part indices of the mesh polygons. -1 is either not assigned to a face map or not a valid
@@ -570,13 +584,18 @@ class Mesh:
         if len(index_group_map) <= 1:
             # there were no valid face maps
             return []
-        bm = bmesh.new()
-        bm.from_mesh(b_mesh)
-        bm.faces.ensure_lookup_table()
-        fm = bm.faces.layers.face_map.verify()
-        polygon_parts = [index_group_map.get(face[fm], -1) for face in bm.faces]
-        bm.free()
-        return polygon_parts
+        if b_mesh.face_maps:
+            face_map_indices = self.get_attribute_array(b_mesh.face_maps[0].data, "value", np.int32)
+        else:
+            # no face map layer, so no polygon is assigned to a face map
+            face_map_indices = np.full(len(b_mesh.polygons), -1, dtype=np.int32)
+        # look up table for face map index + 1 -> body part, indices outside index_group_map map to -1
+        part_lut = np.full(max(index_group_map) + 2, -1, dtype=object)
+        for face_map_index, body_part in index_group_map.items():
+            part_lut[face_map_index + 1] = body_part
+        lut_indices = face_map_indices + 1
+        lut_indices[(lut_indices < 0) | (lut_indices >= len(part_lut))] = 0
+        return part_lut[lut_indices].tolist()
 
     def create_skin_inst_data(self, b_obj, b_obj_armature, polygon_parts):
         if bpy.context.scene.niftools_scene.game in ('FALLOUT_3', 'SKYRIM') and polygon_parts:
@@ -609,163 +628,186 @@ class Mesh:
         return skininst, skindata
 
     # TODO [object][flags] Move up to object
-    def set_mesh_flags(self, b_obj, trishape):
+    def set_mesh_flags(self, b_obj, trishape, game):
         # use blender flags
         if (b_obj.type == 'MESH') and (b_obj.niftools.flags != 0):
             trishape.flags = b_obj.niftools.flags
         # fall back to defaults
         else:
-            if bpy.context.scene.niftools_scene.game in ('OBLIVION', 'FALLOUT_3', 'SKYRIM'):
-                trishape.flags = 0x000E
-
-            elif bpy.context.scene.niftools_scene.game in ('SID_MEIER_S_RAILROADS', 'CIVILIZATION_IV'):
-                trishape.flags = 0x0010
-            elif bpy.context.scene.niftools_scene.game in ('EMPIRE_EARTH_II',):
-                trishape.flags = 0x0016
-            elif bpy.context.scene.niftools_scene.game in ('DIVINITY_2',):
-                if trishape.name.lower[-3:] in ("med", "low"):
+            flags = GAME_DEFAULT_FLAGS.get(game)
+            if flags is not None:
+                trishape.flags = flags
+            elif game == 'DIVINITY_2':
+                if trishape.name.lower().endswith(("med", "low")):
                     trishape.flags = 0x0014
                 else:
                     trishape.flags = 0x0016
             else:
-                # morrowind
-                if b_obj.display_type != 'WIRE':  # not wire
-                    trishape.flags = 0x0004  # use triangles as bounding box
-                else:
-                    trishape.flags = 0x0005  # use triangles as bounding box + hide
+                # morrowind: use triangles as bounding box, + hide for wire display
+                trishape.flags = 0x0004 + (b_obj.display_type == 'WIRE')
+
+    @staticmethod
+    def select_mesh_object(b_obj):
+        """Make b_obj the only selected and the active object, leaving the view layer in object mode."""
+        # switch to object mode so (de)selecting objects works
+        if bpy.context.mode != 'OBJECT':
+            bpy.ops.object.mode_set(mode='OBJECT', toggle=False)
+        bpy.ops.object.select_all(action='DESELECT')
+        bpy.context.view_layer.objects.active = b_obj
+
+    @staticmethod
+    def deselect_mesh(b_mesh):
+        """Deselect all vertices, edges and polygons of b_mesh, which must not be in edit mode"""
+        for elements in (b_mesh.vertices, b_mesh.edges, b_mesh.polygons):
+            elements.foreach_set("select", np.zeros(len(elements), dtype=bool))
+
+    def select_mesh_elements(self, b_obj, elements, indices, select_mode):
+        """Shows b_obj in edit mode, with only the given indices of elements (its vertices or polygons) selected"""
+        self.select_mesh_object(b_obj)
+        bpy.context.tool_settings.mesh_select_mode = select_mode
+        # write the selection in object mode, so a single switch to edit mode is needed to show it
+        self.deselect_mesh(b_obj.data)
+        selection = np.zeros(len(elements), dtype=bool)
+        selection[indices] = True
+        elements.foreach_set("select", selection)
+        bpy.ops.object.mode_set(mode='EDIT', toggle=False)
 
-    # todo [mesh] join code paths for those two?
     def select_unweighted_vertices(self, b_obj, unweighted_vertices):
         # vertices must be assigned at least one vertex group lets be nice and display them for the user
         if len(unweighted_vertices) > 0:
-            for b_scene_obj in bpy.context.scene.objects:
-                b_scene_obj.select_set(False)
-
-            bpy.context.view_layer.objects.active = b_obj
-
-            # switch to edit mode to deselect everything in the mesh (not missing vertices or edges)
-            bpy.ops.object.mode_set(mode='EDIT', toggle=False)
-            bpy.context.tool_settings.mesh_select_mode = (True, False, False)
-            bpy.ops.mesh.select_all(action='DESELECT')
-
-            # select unweighted vertices - switch back to object mode to make per-vertex selection
-            bpy.ops.object.mode_set(mode='OBJECT', toggle=False)
-            for vert_index in unweighted_vertices:
-                b_obj.data.vertices[vert_index].select = True
-
-            # switch back to edit mode to make the selection visible and raise exception
-            bpy.ops.object.mode_set(mode='EDIT', toggle=False)
-
+            self.select_mesh_elements(b_obj, b_obj.data.vertices, unweighted_vertices, (True, False, False))
             raise NifError("Cannot export mesh with unweighted vertices. "
                            "The unweighted vertices have been selected in the mesh so they can easily be identified.")
 
     def select_unassigned_polygons(self, b_mesh, b_obj, polygons_without_bodypart):
         """Select any faces which are not weighted to a vertex group"""
+        if len(polygons_without_bodypart) == 0:
+            return
         ngon_mesh = b_obj.data
-        # make vertex: poly map of the untriangulated mesh
-        vert_poly_dict = {i: set() for i in range(len(ngon_mesh.vertices))}
-        for face in ngon_mesh.polygons:
-            for vertex in face.vertices:
-                vert_poly_dict[vertex].add(face.index)
-
-        # translate the tris of polygons_without_bodypart to polygons (assuming vertex order does not change)
-        ngons_without_bodypart = []
-        for face in polygons_without_bodypart:
-            poly_set = vert_poly_dict[face.vertices[0]]
-            for vertex in face.vertices[1:]:
-                poly_set = poly_set.intersection(vert_poly_dict[vertex])
-                if len(poly_set) == 0:
-                    break
-            else:
-                for poly in poly_set:
-                    ngons_without_bodypart.append(poly)
-
-        # switch to object mode so (de)selecting faces works
-        bpy.ops.object.mode_set(mode='OBJECT', toggle=False)
-        # select mesh object
-        for b_deselect_obj in bpy.context.scene.objects:
-            b_deselect_obj.select_set(False)
-        bpy.context.view_layer.objects.active = b_obj
-        # switch to edit mode to deselect everything in the mesh (not missing vertices or edges)
-        bpy.ops.object.mode_set(mode='EDIT', toggle=False)
-        bpy.context.tool_settings.mesh_select_mode = (False, False, True)
-        bpy.ops.mesh.select_all(action='DESELECT')
-
-        # switch back to object mode to make per-face selection
-        bpy.ops.object.mode_set(mode='OBJECT', toggle=False)
-        for poly in ngons_without_bodypart:
-            ngon_mesh.polygons[poly].select = True
-
-        # select bad polygons switch to edit mode to select polygons
-        bpy.ops.object.mode_set(mode='EDIT', toggle=False)
+        # make vertex: poly map of the untriangulated mesh, as compressed sparse rows: the polygons of vertex v are
+        # vert_poly_indices[vert_poly_indptr[v]:vert_poly_indptr[v + 1]]
+        ngon_loop_totals = self.get_attribute_array(ngon_mesh.polygons, "loop_total", np.int32)
+        ngon_loop_vertices = self.get_attribute_array(ngon_mesh.loops, "vertex_index", np.int32)
+        ngon_loop_polys = np.repeat(np.arange(len(ngon_loop_totals), dtype=np.int32), ngon_loop_totals)
+        vertex_order = np.argsort(ngon_loop_vertices, kind='stable')
+        vert_poly_indices = ngon_loop_polys[vertex_order]
+        vert_poly_indptr = np.searchsorted(ngon_loop_vertices[vertex_order], np.arange(len(ngon_mesh.vertices) + 1))
+
+        # translate the polygons_without_bodypart of b_mesh to polygons (assuming vertex order does not change): a
+        # face belongs to every polygon that is found once for each of its vertices
+        faces = np.unique(polygons_without_bodypart)
+        face_loop_starts = self.get_attribute_array(b_mesh.polygons, "loop_start", np.int32)[faces]
+        face_vertex_totals = self.get_attribute_array(b_mesh.polygons, "loop_total", np.int32)[faces]
+        face_vertices = self.get_attribute_array(b_mesh.loops, "vertex_index", np.int32)[
+            self.expand_ranges(face_loop_starts, face_vertex_totals)]
+        vertex_poly_totals = vert_poly_indptr[face_vertices + 1] - vert_poly_indptr[face_vertices]
+        candidate_polys = vert_poly_indices[self.expand_ranges(vert_poly_indptr[face_vertices], vertex_poly_totals)]
+        candidate_faces = np.repeat(np.repeat(np.arange(len(face_vertex_totals)), face_vertex_totals),
+                                    vertex_poly_totals)
+        # count each (face, polygon) pair with a single sort
+        num_polys = len(ngon_loop_totals)
+        face_polys, face_poly_counts = np.unique(candidate_faces * num_polys + candidate_polys, return_counts=True)
+        face_polys = face_polys[face_poly_counts == face_vertex_totals[face_polys // num_polys]]
+        ngons_without_bodypart = face_polys % num_polys
+
+        self.select_mesh_elements(b_obj, ngon_mesh.polygons, ngons_without_bodypart, (False, False, True))
 
         # raise exception
         raise NifError(f"Some polygons of {b_obj.name} not assigned to any body part."
                        f"The unassigned polygons have been selected in the mesh so they can easily be identified.")
 
-    def is_new_face_corner_data(self, vertquad, v_quad_old):
-        """Compares vert info to old vert info if relevant data is present"""
-        # uvs
-        if v_quad_old[1]:
-            for i in range(2):
-                if max(abs(vertquad[1][uv_index][i] - v_quad_old[1][uv_index][i]) for uv_index in
-                       range(len(v_quad_old[1]))) > NifOp.props.epsilon:
-                    return True
-        # normals
-        if v_quad_old[2]:
-            for i in range(3):
-                if abs(vertquad[2][i] - v_quad_old[2][i]) > NifOp.props.epsilon:
-                    return True
-        # vcols
-        if v_quad_old[3]:
-            for i in range(4):
-                if abs(vertquad[3][i] - v_quad_old[3][i]) > NifOp.props.epsilon:
-                    return True
+    @staticmethod
+    def quantize_face_corner_data(data):
+        """Maps face corner data to an int32 lattice by rounding it to the nearest multiple of epsilon.
+        Without epsilon, the float32 bit patterns are used, so only identical data maps to the same point."""
+        epsilon = NifOp.props.epsilon
+        if epsilon > 0:
+            return np.rint(data / epsilon).astype(np.int32)
+        return np.ascontiguousarray(data, dtype=np.float32).view(np.int32)
 
     def export_texture_effect(self, n_block, b_mat):
-        # todo [texture] detect effect
-        ref_mtex = False
-        if ref_mtex:
-            # create a new parent block for this shape
-            extra_node = block_store.create_block("NiNode", ref_mtex)
-            n_block.add_child(extra_node)
-            # set default values for this ninode
-            extra_node.rotation.set_identity()
-            extra_node.scale = 1.0
-            extra_node.flags = 0x000C  # morrowind
-            # create texture effect block and parent the texture effect and n_geom to it
-            texeff = self.texture_helper.export_texture_effect(ref_mtex)
-            extra_node.add_child(texeff)
-            extra_node.add_effect(texeff)
-            return extra_node
+        # todo [texture] detect effect, then parent it and n_block to a new NiNode
+        #  (see NiTextureProp.export_texture_effect)
         return n_block
 
-    def get_triangulated_mesh(self, b_obj):
-        # TODO [geometry][mesh] triangulation could also be done using loop_triangles, without a modifier
+    @contextmanager
+    def get_evaluated_mesh(self, b_obj):
+        """Context manager that yields the mesh of b_obj with all modifiers applied, in the rest position of its
+        armature, and frees it again on exit. Polygons with more than 4 sides are triangulated, tris and quads are
+        kept."""
         # get the armature influencing this mesh, if it exists
         b_armature_obj = b_obj.find_armature()
         if b_armature_obj:
             old_position = b_armature_obj.data.pose_position
             b_armature_obj.data.pose_position = 'REST'
 
-        # make sure the model has a triangulation modifier
-        self.ensure_tri_modifier(b_obj)
-
         # make a copy with all modifiers applied
-        dg = bpy.context.evaluated_depsgraph_get()
-        eval_obj = b_obj.evaluated_get(dg)
-        eval_mesh = eval_obj.to_mesh(preserve_all_data_layers=True, depsgraph=dg)
-        if b_armature_obj:
-            b_armature_obj.data.pose_position = old_position
-        return eval_mesh
-
-    def ensure_tri_modifier(self, b_obj):
-        """Makes sure that ob has a triangulation modifier in its stack."""
-        for mod in b_obj.modifiers:
-            if mod.type in ('TRIANGULATE',):
-                break
-        else:
-            b_obj.modifiers.new('Triangulate', 'TRIANGULATE')
+        try:
+            dg = bpy.context.evaluated_depsgraph_get()
+            eval_obj = b_obj.evaluated_get(dg)
+            eval_mesh = eval_obj.to_mesh(preserve_all_data_layers=True, depsgraph=dg)
+        finally:
+            # the copy does not depend on the pose position anymore, so restore it even if the evaluation failed
+            if b_armature_obj:
+                b_armature_obj.data.pose_position = old_position
+        try:
+            # triangles are taken from the mesh's loop_triangles, but tangent space can only be calculated for tris
+            # and quads, so only the polygons with more sides are triangulated here
+            poly_loop_totals = self.get_attribute_array(eval_mesh.polygons, "loop_total", np.int32)
+            if np.any(poly_loop_totals > 4):
+                bm = bmesh.new()
+                try:
+                    bm.from_mesh(eval_mesh)
+                    bmesh.ops.triangulate(bm, faces=[face for face in bm.faces if len(face.verts) > 4])
+                    bm.to_mesh(eval_mesh)
+                finally:
+                    bm.free()
+            yield eval_mesh
+        finally:
+            eval_obj.to_mesh_clear()
+
+    @staticmethod
+    def get_face_corner_vertices(corner_keys, loops):
+        """Assigns a nif vertex to each of the given loops, such that loops with equal corner keys share their vertex.
+        Returns the nif vertex of each loop, and for each nif vertex the first loop that was assigned to it."""
+        # view each row of corner keys as one opaque value, so that equal corners can be found by a single sort
+        corner_keys = np.ascontiguousarray(corner_keys)
+        row_keys = corner_keys.view(np.dtype((np.void, corner_keys.itemsize * corner_keys.shape[1]))).ravel()
+        _, first_loops, loop_keys = np.unique(row_keys[loops], return_index=True, return_inverse=True)
+        # number the unique keys by their first appearance, so vertices keep the order of the loops
+        key_order = np.argsort(first_loops)
+        key_vertices = np.empty(len(key_order), dtype=np.int32)
+        key_vertices[key_order] = np.arange(len(key_order), dtype=np.int32)
+        return key_vertices[loop_keys.ravel()], loops[first_loops[key_order]].astype(np.int32)
+
+    @staticmethod
+    def group_indices(keys, num_groups):
+        """Returns for each group 0 <= g < num_groups the indices i with keys[i] == g, in increasing order"""
+        order = np.argsort(keys, kind='stable')
+        bounds = np.searchsorted(keys[order], np.arange(num_groups + 1))
+        return [order[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+
+    @staticmethod
+    def expand_ranges(starts, counts):
+        """Returns the concatenation of range(start, start + count) for all starts and counts as a single array"""
+        return np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(np.sum(counts))
+
+    @staticmethod
+    def set_vector3_array(n_vectors, b_vectors):
+        """Writes an (N, 3) array to a nif array of Vector3. The rows are converted to plain floats in one call and
+        set struct by struct."""
+        for n_v, b_v in zip(n_vectors, b_vectors.tolist()):
+            n_v.x, n_v.y, n_v.z = b_v
+
+    @staticmethod
+    def get_attribute_array(collection, attribute, dtype, size=1):
+        """Returns an attribute of all items of a bpy collection as a numpy array, using a single foreach_get call.
+        Attributes with more than one component are returned with shape (len(collection), size)."""
+        array = np.empty(len(collection) * size, dtype=dtype)
+        collection.foreach_get(attribute, array)
+        if size > 1:
+            array.shape = (-1, size)
+        return array
 
     def add_defined_tangents(self, n_geom, tangents, bitangents, as_extra_data):
         # check if size of tangents and bitangents is equal to num_vertices
@@ -785,16 +827,17 @@ class Mesh:
                 extra = NifClasses.NiBinaryExtraData(NifData.data)
                 extra.name = extra_name
                 n_geom.add_extra_data(extra)
-            # write the data
-            extra.binary_data = np.concatenate((tangents, bitangents), axis=0).astype('<f').tobytes()
+            # write the data, packed into a single buffer of the output type, so that no intermediate array is needed
+            tangent_space = np.empty((len(tangents) + len(bitangents), 3), dtype='<f4')
+            tangent_space[:len(tangents)] = tangents
+            tangent_space[len(tangents):] = bitangents
+            extra.binary_data = tangent_space.tobytes()
         else:
             # set tangent space flag
             n_geom.data.extra_vectors_flags = 16
             # XXX used to be 61440
             # XXX from Sid Meier's Railroad
             n_geom.data.reset_field("tangents")
-            for n_v, b_v in zip(n_geom.data.tangents, tangents):
-                n_v.x, n_v.y, n_v.z = b_v
+            self.set_vector3_array(n_geom.data.tangents, tangents)
             n_geom.data.reset_field("bitangents")
-            for n_v, b_v in zip(n_geom.data.bitangents, bitangents):
-                n_v.x, n_v.y, n_v.z = b_v
+            self.set_vector3_array(n_geom.data.bitangents, bitangents)